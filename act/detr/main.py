@@ -129,6 +129,18 @@ def get_args_parser():
     parser.add_argument("--ckpt_names", action="store", nargs="*", help="ckpt_names")
     parser.add_argument("--few_shot", action="store", type=int, help="few_shot")
     parser.add_argument("--ent_weight", action="store", type=float, help="ent_weight")
+    parser.add_argument("--cuda_graph", action="store_true")
+    parser.add_argument("--compile_model", action="store_true")
+    parser.add_argument(
+        "--compile_mode", action="store", type=str, default="reduce-overhead"
+    )
+    parser.add_argument(
+        "--autocast_dtype",
+        action="store",
+        type=str,
+        default="none",
+        choices=("bfloat16", "float16", "none"),
+    )
 
     return parser
 
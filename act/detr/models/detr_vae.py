@@ -115,6 +115,8 @@ class DETRVAE(nn.Module):
         image: batch, num_cam, channel, height, width
         env_state: None
         actions: batch, seq, action_dim
+            May hold batch / k rows; the CVAE encoder then runs once on them and
+            its latent is reused for all k repeats of the decoder batch
         """
         skill_ind = kwargs[
             "skill_ind"
@@ -124,9 +126,12 @@ class DETRVAE(nn.Module):
         bs, _ = qpos.shape
         ### Obtain latent z from action sequence
         if is_training:
+            num_repeats = bs // actions.shape[0]
+            assert num_repeats * actions.shape[0] == bs
+            bs = actions.shape[0]  # encoder batch
             # project action sequence to embedding dim, and concat with a CLS token
             action_embed = self.encoder_action_proj(actions)  # (bs, seq, hidden_dim)
-            qpos_embed = self.encoder_joint_proj(qpos)  # (bs, hidden_dim)
+            qpos_embed = self.encoder_joint_proj(qpos[:bs])  # (bs, hidden_dim)
             qpos_embed = torch.unsqueeze(qpos_embed, axis=1)  # (bs, 1, hidden_dim)
             cls_embed = self.cls_embed.weight  # (1, hidden_dim)
             cls_embed = torch.unsqueeze(cls_embed, axis=0).repeat(
@@ -154,6 +159,8 @@ class DETRVAE(nn.Module):
             logvar = latent_info[:, self.latent_dim :]
             latent_sample = reparametrize(mu, logvar)
             latent_input = self.latent_out_proj(latent_sample)
+            latent_input = latent_input.repeat(num_repeats, 1)
+            bs = qpos.shape[0]
 
         else:
             mu = logvar = None
@@ -161,9 +168,9 @@ class DETRVAE(nn.Module):
             # latent_sample = torch.normal(
             #     0, 1, [bs, self.latent_dim], dtype=torch.float32
             # ).to(qpos.device)
-            latent_sample = torch.zeros([bs, self.latent_dim], dtype=torch.float32).to(
-                qpos.device
-            )
+            latent_sample = torch.zeros(
+                [bs, self.latent_dim], dtype=torch.float32, device=qpos.device
+            )  # allocate on device so the inference pass can be graph captured
             latent_input = self.latent_out_proj(latent_sample)
 
         # TODO: condition on the skill
@@ -213,7 +220,10 @@ class DETRVAE(nn.Module):
             hs = self.transformer(
                 transformer_input, None, self.query_embed.weight, self.pos.weight
             )[0]
-        a_hat = self.action_head(hs)
+        # Keep the action projection in fp32 under autocast, rounding the actions
+        # to bf16/fp16 costs ~0.01 rad per joint once de-normalized
+        with torch.autocast("cuda", enabled=False):
+            a_hat = self.action_head(hs.float())
         is_pad_hat = self.is_pad_head(hs)
         return a_hat, is_pad_hat, [mu, logvar]
 
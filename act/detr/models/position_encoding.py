@@ -31,7 +31,7 @@ class PositionEmbeddingSine(nn.Module):
         # assert mask is not None
         # not_mask = ~mask
 
-        not_mask = torch.ones_like(x[0, [0]])
+        not_mask = torch.ones_like(x[0, :1])  # slice, not list index: no H2D copy
         y_embed = not_mask.cumsum(1, dtype=torch.float32)
         x_embed = not_mask.cumsum(2, dtype=torch.float32)
         if self.normalize:
@@ -7,7 +7,6 @@ import argparse
 import matplotlib.pyplot as plt
 from copy import deepcopy
 from tqdm import tqdm
-from einops import rearrange
 import datetime
 from utils import (
     compute_dict_mean,
@@ -16,7 +15,11 @@ from utils import (
     save_videos,
 )  # helper functions
 from policy import ACTPolicy, CNNMLPPolicy
-from rl_bench.torch_data import load_data as load_rlbench_data, ReverseTrajDataset
+from rl_bench.torch_data import (
+    load_data as load_rlbench_data,
+    ReverseTrajDataset,
+    PrefetchLoader,
+)
 from rlbench.tasks import (
     OpenDoor,
     OpenBox,
@@ -94,6 +97,10 @@ def main(args):
             "state_dim": state_dim,
             "few_shot": few_shot,
             "ent_weight": ent_weight,
+            "cuda_graph": args["cuda_graph"],
+            "compile_model": args["compile_model"],
+            "compile_mode": args["compile_mode"],
+            "autocast_dtype": args["autocast_dtype"],
         }
     elif policy_class == "CNNMLP":
         policy_config = {
@@ -102,6 +109,7 @@ def main(args):
             "backbone": backbone,
             "num_queries": 1,
             "camera_names": camera_names,
+            "autocast_dtype": args["autocast_dtype"],
         }
     else:
         raise NotImplementedError
@@ -157,7 +165,10 @@ def main(args):
         batch_size=batch_size,
         add_task_ind=add_task_ind,
         few_shot=few_shot,
+        preload=bool(few_shot),  # a handful of demos fits in memory
     )
+    train_dataloader = PrefetchLoader(train_dataloader)
+    val_dataloader = PrefetchLoader(val_dataloader)
 
     # Save configuration
     config["rlbench_env"] = str(config["rlbench_env"])
@@ -202,10 +213,10 @@ def get_image(obs, camera_names):
     for cam_name in camera_names:
         curr_image = getattr(obs, cam_name)
         viz_out[cam_name] = curr_image
-        curr_image = rearrange(curr_image, "h w c -> c h w")
         curr_images.append(curr_image)
+    # uint8 channel last, the policy normalizes on the device
     curr_image = np.stack(curr_images, axis=0)
-    curr_image = torch.from_numpy(curr_image / 255.0).float().cuda().unsqueeze(0)
+    curr_image = torch.from_numpy(curr_image).cuda().unsqueeze(0)
     return curr_image, viz_out
 
 
@@ -456,6 +467,10 @@ def train_bc(train_dataloader, val_dataloader, config):
     set_seed(seed)
     policy = make_policy(policy_class, policy_config)
     optimizer = make_optimizer(policy_class, policy)
+    # fp16 autocast needs loss scaling, bf16 has the fp32 exponent range
+    scaler = torch.cuda.amp.GradScaler(
+        enabled=policy_config.get("autocast_dtype") == "float16"
+    )
 
     if len(ckpt_names) > 0:
         # load policy and stats
@@ -500,8 +515,9 @@ def train_bc(train_dataloader, val_dataloader, config):
             forward_dict = forward_pass(data, policy)
             # backward
             loss = forward_dict["loss"]
-            loss.backward()
-            optimizer.step()
+            scaler.scale(loss).backward()
+            scaler.step(optimizer)
+            scaler.update()
             optimizer.zero_grad()
             train_history.append(detach_dict(forward_dict))
         epoch_summary = compute_dict_mean(
@@ -609,5 +625,17 @@ if __name__ == "__main__":
     parser.add_argument("--ckpt_names", action="store", nargs="*", help="ckpt_names")
     parser.add_argument("--few_shot", action="store", type=int, help="few_shot")
     parser.add_argument("--ent_weight", action="store", type=float, help="ent_weight")
+    parser.add_argument("--cuda_graph", action="store_true")
+    parser.add_argument("--compile_model", action="store_true")
+    parser.add_argument(
+        "--compile_mode", action="store", type=str, default="reduce-overhead"
+    )
+    parser.add_argument(
+        "--autocast_dtype",
+        action="store",
+        type=str,
+        default="none",
+        choices=("bfloat16", "float16", "none"),
+    )
 
     main(vars(parser.parse_args()))
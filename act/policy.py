@@ -1,10 +1,42 @@
+from typing import Optional
+
 import torch.nn as nn
 from torch.nn import functional as F
-import torchvision.transforms as transforms
 import torch
 
 from detr.main import build_ACT_model_and_optimizer, build_CNNMLP_model_and_optimizer
 
+IMAGENET_MEAN = torch.tensor([0.485, 0.456, 0.406])
+IMAGENET_STD = torch.tensor([0.229, 0.224, 0.225])
+# Scaled by 255 to normalize the uint8 images without a separate /255
+IMAGE_MEAN_255 = (255 * IMAGENET_MEAN).view(1, 1, 3, 1, 1)
+IMAGE_STD_255 = (255 * IMAGENET_STD).view(1, 1, 3, 1, 1)
+
+
+def normalize_image(image, mean, std):
+    """uint8 [bs, num_cam, h, w, c] -> normalized float [bs, num_cam, c, h, w]"""
+    # float() copies a uint8 input, so the in-place ops never touch the caller's
+    assert image.dtype == torch.uint8
+    image = image.permute(0, 1, 4, 2, 3).float().sub_(mean)
+    return image.div_(std)
+
+
+def get_autocast_dtype(args_override):
+    """torch dtype named by args_override["autocast_dtype"], None disables AMP"""
+    dtype = args_override.get("autocast_dtype")
+    if dtype is None or dtype == "none":
+        return None
+    if dtype == "bfloat16" and not torch.cuda.is_bf16_supported():
+        print("bfloat16 is not supported on this GPU, disabling autocast")
+        return None
+    return getattr(torch, dtype)
+
+
+def autocast(dtype, **kwargs):
+    """Mixed precision context for the CUDA forward pass, no-op if dtype is None"""
+    return torch.autocast("cuda", dtype=dtype, enabled=dtype is not None, **kwargs)
+
+
 class ACTPolicy(nn.Module):
     def __init__(self, args_override):
         super().__init__()
@@ -14,62 +46,143 @@ class ACTPolicy(nn.Module):
         self.kl_weight = args_override["kl_weight"]
         self.few_shot = args_override["few_shot"]
         self.ent_weight = args_override["ent_weight"]
+        self.autocast_dtype = get_autocast_dtype(args_override)
+        # Mean and std from Imagenet => Should we change this?
+        self.register_buffer("img_mean", IMAGE_MEAN_255.clone(), persistent=False)
+        self.register_buffer("img_std", IMAGE_STD_255.clone(), persistent=False)
+        # l1_uninf placeholder for few-shot training, lives on the policy device
+        self.register_buffer("_zero", torch.zeros(()), persistent=False)
+        # Replay the inference forward pass from a captured CUDA graph
+        self.cuda_graph = args_override.get("cuda_graph", False)
+        self._graph = None
+        self._static_inputs = None  # (qpos, image, skill_ind, env_ind)
+        self._static_out = None
+        # torch.compile the bound forward rather than the module itself, so that
+        # self.model stays the eager module and the state_dict keys are unchanged
+        self._compiled_forward = None
+        if args_override.get("compile_model", False):
+            compile_mode = args_override.get("compile_mode", "reduce-overhead")
+            if self.cuda_graph and compile_mode in ("reduce-overhead", "max-autotune"):
+                raise ValueError(
+                    f"compile_mode={compile_mode} already uses CUDA graphs, "
+                    "drop --cuda_graph or pick another compile_mode"
+                )
+            self._compiled_forward = torch.compile(
+                self.model.forward, mode=compile_mode, dynamic=False
+            )
         print(f"KL Weight {self.kl_weight}")
 
     def __call__(self, qpos, image, actions=None, is_pad=None, **kwargs):
-        env_state = None
-        # Mean and std from Imagenet => Should we change this?
-        normalize = transforms.Normalize(
-            mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]
-        )
-        image = normalize(image)
         if actions is not None:  # training time
-            actions = actions[:, : self.model.num_queries]
-            is_pad = is_pad[:, : self.model.num_queries]
+            return self.forward_train(qpos, image, actions, is_pad, **kwargs)
+        # inference time
+        if self.cuda_graph and not self.training:
+            return self._graphed_inference(qpos, image, **kwargs)
+        return self.forward_infer(qpos, image, **kwargs)
 
-            loss_dict = dict()
-            a_hat, is_pad_hat, (mu, logvar) = self.model(
-                qpos, image, env_state, actions, is_pad, **kwargs
-            )
-            total_kld, dim_wise_kld, mean_kld = kl_divergence(mu, logvar)
-            all_l1 = F.l1_loss(actions, a_hat, reduction="none")
-            l1 = (all_l1 * ~is_pad.unsqueeze(-1)).mean()
-            loss_dict["l1"] = l1
-
-            # For uninformative baseline
-            loss_dict["l1_uninf"] = torch.tensor(0.0)
-            if not self.few_shot:
+    def forward_train(self, qpos, image, actions, is_pad, **kwargs):
+        env_state = None
+        image = normalize_image(image, self.img_mean, self.img_std)
+        actions = actions[:, : self.model.num_queries]
+        is_pad = is_pad[:, : self.model.num_queries]
+
+        loss_dict = dict()
+        with autocast(self.autocast_dtype):
+            if self.few_shot:
+                a_hat, is_pad_hat, (mu, logvar) = self._run_model(
+                    qpos, image, env_state, actions, is_pad, **kwargs
+                )
+                a_hat_uninf = None
+            else:
+                # Stack the uninformative baseline (zero skill_ind) onto the batch
+                # so that both predictions come from a single forward pass. The
+                # actions are not repeated: the CVAE encoder (which does not see
+                # skill_ind) runs once and its latent is shared by both halves
+                skill_ind = kwargs.get("skill_ind")
                 env_ind = kwargs.get("env_ind")
-                skill_ind = torch.zeros(
-                    kwargs.get("skill_ind").shape, dtype=torch.float32
-                ).cuda()  # uninformative baseline
-                a_hat_uninf, _, (_, _) = self.model(
-                    qpos,
-                    image,
+                # uninformative baseline
+                skill_ind_uninf = torch.zeros_like(skill_ind)
+                a_hat, is_pad_hat, (mu, logvar) = self._run_model(
+                    torch.cat([qpos, qpos]),
+                    torch.cat([image, image]),
                     env_state,
                     actions,
                     is_pad,
-                    skill_ind=skill_ind,
-                    env_ind=env_ind,
+                    skill_ind=torch.cat([skill_ind, skill_ind_uninf]),
+                    env_ind=torch.cat([env_ind, env_ind]),
                 )
-                all_l1_uninf = F.l1_loss(actions, a_hat_uninf, reduction="none")
-                l1_uninf = (all_l1_uninf * ~is_pad.unsqueeze(-1)).mean()
-                loss_dict["l1_uninf"] = (
-                    self.ent_weight if self.ent_weight else 0.01
-                ) * l1_uninf
-
-            loss_dict["kl"] = total_kld[0]
-            loss_dict["loss"] = (
-                loss_dict["l1"]
-                + loss_dict["l1_uninf"]
-                + loss_dict["kl"] * self.kl_weight
-            )
-            return loss_dict
-        else:  # inference time
-            a_hat, _, (_, _) = self.model(
-                qpos, image, env_state, **kwargs
+                a_hat, a_hat_uninf = a_hat.chunk(2, 0)
+
+        # Keep the KL term in fp32 for numerical stability
+        l1, l1_uninf, kl, loss = _act_losses(
+            a_hat,
+            actions,
+            is_pad,
+            mu.float(),
+            logvar.float(),
+            float(self.kl_weight),
+            self.ent_weight if self.ent_weight else 0.01,
+            a_hat_uninf,
+        )
+        loss_dict["l1"] = l1
+        # For uninformative baseline
+        loss_dict["l1_uninf"] = self._zero if l1_uninf is None else l1_uninf
+        loss_dict["kl"] = kl
+        loss_dict["loss"] = loss
+        return loss_dict
+
+    def forward_infer(self, qpos, image, skill_ind, env_ind):
+        """
+        Tensor-only inference pass without Python-side branching on the inputs,
+        so that it can be captured in a CUDA graph
+        """
+        image = normalize_image(image, self.img_mean, self.img_std)
+        # The autocast weight cache must not outlive a graph capture
+        with autocast(self.autocast_dtype, cache_enabled=not self.cuda_graph):
+            a_hat, _, (_, _) = self._run_model(
+                qpos, image, None, skill_ind=skill_ind, env_ind=env_ind
             )  # no action, sample from prior
-            return a_hat
+        return a_hat.float()
+
+    def _run_model(self, *args, **kwargs):
+        if self._compiled_forward is not None:
+            return self._compiled_forward(*args, **kwargs)
+        return self.model(*args, **kwargs)
+
+    def _graphed_inference(self, qpos, image, skill_ind, env_ind, num_warmup=3):
+        """
+        Capture forward_infer in a CUDA graph on the first call and replay it
+        afterwards. Inputs are copied into static buffers, so the graph is
+        re-captured only if an input shape changes. Capture and replay run under
+        inference_mode, so no autograd state is recorded and the static buffers
+        are always written from the same mode they were created in.
+        """
+        inputs = (qpos, image, skill_ind, env_ind)
+        with torch.inference_mode():
+            if self._graph is None or any(
+                static.shape != new.shape
+                for static, new in zip(self._static_inputs, inputs)
+            ):
+                self._static_inputs = tuple(x.clone() for x in inputs)
+
+                # Warmup on a side stream so that lazy initializations are not captured
+                stream = torch.cuda.Stream()
+                stream.wait_stream(torch.cuda.current_stream())
+                with torch.cuda.stream(stream):
+                    for _ in range(num_warmup):
+                        self.forward_infer(*self._static_inputs)
+                torch.cuda.current_stream().wait_stream(stream)
+                torch.cuda.synchronize()
+
+                self._graph = torch.cuda.CUDAGraph()
+                with torch.cuda.graph(self._graph):
+                    self._static_out = self.forward_infer(*self._static_inputs)
+            else:
+                for static, new in zip(self._static_inputs, inputs):
+                    static.copy_(new)
+
+            self._graph.replay()
+            return self._static_out.clone()
 
     def configure_optimizers(self):
         return self.optimizer
@@ -81,40 +194,74 @@ class CNNMLPPolicy(nn.Module):
         model, optimizer = build_CNNMLP_model_and_optimizer(args_override)
         self.model = model  # decoder
         self.optimizer = optimizer
+        self.autocast_dtype = get_autocast_dtype(args_override)
+        self.register_buffer("img_mean", IMAGE_MEAN_255.clone(), persistent=False)
+        self.register_buffer("img_std", IMAGE_STD_255.clone(), persistent=False)
 
     def __call__(self, qpos, image, actions=None, is_pad=None):
         env_state = None  # TODO
-        normalize = transforms.Normalize(
-            mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]
-        )
-        image = normalize(image)
+        image = normalize_image(image, self.img_mean, self.img_std)
         if actions is not None:  # training time
             actions = actions[:, 0]
-            a_hat = self.model(qpos, image, env_state, actions)
-            mse = F.mse_loss(actions, a_hat)
+            with autocast(self.autocast_dtype):
+                a_hat = self.model(qpos, image, env_state, actions)
+                mse = F.mse_loss(actions, a_hat)
             loss_dict = dict()
             loss_dict["mse"] = mse
             loss_dict["loss"] = loss_dict["mse"]
             return loss_dict
         else:  # inference time
-            a_hat = self.model(qpos, image, env_state)  # no action, sample from prior
-            return a_hat
+            with autocast(self.autocast_dtype):
+                # no action, sample from prior
+                a_hat = self.model(qpos, image, env_state)
+            return a_hat.float()
 
     def configure_optimizers(self):
         return self.optimizer
 
 
-def kl_divergence(mu, logvar):
+@torch.jit.script
+def kl_divergence(mu: torch.Tensor, logvar: torch.Tensor):
+    # Scripted so the elementwise KL terms are fused into a single kernel
     batch_size = mu.size(0)
     assert batch_size != 0
-    if mu.data.ndimension() == 4:
-        mu = mu.view(mu.size(0), mu.size(1))
-    if logvar.data.ndimension() == 4:
-        logvar = logvar.view(logvar.size(0), logvar.size(1))
+    mu = mu.flatten(1)  # [bs, latent, 1, 1] -> [bs, latent]
+    logvar = logvar.flatten(1)
 
     klds = -0.5 * (1 + logvar - mu.pow(2) - logvar.exp())
-    total_kld = klds.sum(1).mean(0, True)
+    total_kld = klds.sum(1).mean(0, keepdim=True)
     dimension_wise_kld = klds.mean(0)
-    mean_kld = klds.mean(1).mean(0, True)
+    mean_kld = klds.mean(1).mean(0, keepdim=True)
 
     return total_kld, dimension_wise_kld, mean_kld
+
+
+@torch.jit.script
+def _act_losses(
+    a_hat: torch.Tensor,
+    actions: torch.Tensor,
+    is_pad: torch.Tensor,
+    mu: torch.Tensor,
+    logvar: torch.Tensor,
+    kl_weight: float,
+    ent_weight: float,
+    a_hat_uninf: Optional[torch.Tensor] = None,
+):
+    """
+    Masked L1, uninformative-baseline L1 and KL losses of ACTPolicy, scripted so
+    that the pointwise ops are fused. Returns (l1, l1_uninf, kl, loss) where
+    l1_uninf is None without a baseline prediction.
+    """
+    # Valid-step mask, shared by the masked mean of both L1 losses
+    mask = (~is_pad).unsqueeze(-1).to(actions.dtype)
+    num_valid = mask.sum().clamp_min(1) * actions.size(-1)
+
+    l1 = ((actions - a_hat).abs() * mask).sum() / num_valid
+    kl = kl_divergence(mu, logvar)[0][0]
+    loss = l1 + kl * kl_weight
+
+    l1_uninf: Optional[torch.Tensor] = None
+    if a_hat_uninf is not None:
+        l1_uninf = ent_weight * ((actions - a_hat_uninf).abs() * mask).sum() / num_valid
+        loss = loss + l1_uninf
+    return l1, l1_uninf, kl, loss
@@ -8,7 +8,33 @@ import random
 import re
 from functools import partial
 
+try:
+    from numba import njit
+except ImportError:  # numba is optional, transform_batch falls back to NumPy
+    njit = None
+
 CONFIG_DIM = 7  # joint space
+REQUIRED_DATA_KEYS = [
+    "front_rgb",
+    "left_shoulder_rgb",
+    "right_shoulder_rgb",
+    "wrist_rgb",
+    "joint_positions",
+    "gripper_open",
+]
+
+
+if njit is not None:
+
+    @njit(cache=True, fastmath=True)
+    def _minmax_normalize(X, min_, max_):
+        """Fused clamp + MinMax transform of X: [T, CONFIG_DIM] in one pass"""
+        out = np.empty_like(X)
+        for i in range(X.shape[0]):
+            for j in range(X.shape[1]):
+                v = min(max(X[i, j], min_[j]), max_[j])
+                out[i, j] = 2.0 * (v - min_[j]) / (max_[j] - min_[j]) - 1.0
+        return out
 
 
 class ConfigMinMaxNormalization(object):
@@ -30,16 +56,45 @@ class ConfigMinMaxNormalization(object):
         X = X * 2.0 - 1.0
         return X
 
+    def transform_batch(self, X):
+        """
+        Clamp X to the bounds and transform it, broadcasting over the last axis
+        X: [..., CONFIG_DIM]
+        """
+        if njit is not None and X.ndim == 2:
+            return _minmax_normalize(X, self._min, self._max)
+        X = self.clamp(X)
+        return 2.0 * (X - self._min) / (self._max - self._min) - 1.0
+
     def inverse_transform(self, X):
         X = (X + 1.0) / 2.0
         X = 1.0 * X * (self._max - self._min) + self._min
         return X
 
     def clamp(self, js):
-        min_ = np.ones(js.shape) * self._min
-        max_ = np.ones(js.shape) * self._max
-        js = np.minimum(np.maximum(js, min_), max_)
-        return js
+        return np.clip(js, self._min, self._max)
+
+
+def convert_pickle_to_npy(path, keys=REQUIRED_DATA_KEYS):
+    """
+    Save the keys of a pickled demo as <demo>/<key>.npy next to the pickle, so
+    that ReverseTrajDataset can memory-map them instead of un-pickling the
+    whole demo for every sample
+    Parameters
+    ---------
+    path
+        Location of the .pickle demo
+    keys: default=REQUIRED_DATA_KEYS
+        Keys to convert, all non-empty keys if None
+    """
+    npy_dir = os.path.splitext(path)[0]
+    os.makedirs(npy_dir, exist_ok=True)
+    with open(path, "rb") as f:
+        demo = pickle.load(f)
+    for key in demo if keys is None else keys:
+        if len(demo[key]) > 0:
+            np.save(os.path.join(npy_dir, f"{key}.npy"), np.asarray(demo[key]))
+    return npy_dir
 
 
 class ReverseTrajDataset(Dataset):
@@ -63,6 +118,13 @@ class ReverseTrajDataset(Dataset):
         "wrist_rgb",
     ]
 
+    # One-hot skill/env indicators, shared by all samples instead of re-created
+    _SKILL_NONE = torch.zeros(2)
+    _SKILL_FWD = torch.tensor([1.0, 0.0])
+    _SKILL_BWD = torch.tensor([0.0, 1.0])
+    _ENV_NONE = torch.zeros(3)
+    _ENV_TAB = torch.eye(3)  # box, toilet seat, grill
+
     def __init__(
         self,
         file_list,
@@ -72,6 +134,7 @@ class ReverseTrajDataset(Dataset):
         add_task_ind=False,
         task_name=None,
         sampler=partial(np.random.uniform, 0, 1),  # partial function
+        preload=False,
     ):
         self.file_list = file_list
         self.required_data_keys = required_data_keys
@@ -85,85 +148,142 @@ class ReverseTrajDataset(Dataset):
         self.add_task_ind = add_task_ind
         self.task_name = task_name
 
+        # Parse the skill and env indicators from the file names only once
+        self.skill_inds, self.env_inds = [], []
+        for file_name in self.file_list:
+            skill_ind, env_ind = self._parse_task_ind(file_name)
+            self.skill_inds.append(skill_ind)
+            self.env_inds.append(env_ind)
+
+        self._use_npy = {}  # per-demo result of the .npy freshness check
+
+        # Decode (and normalize) every demo once, __getitem__ then only slices.
+        # Arrays are kept in regular memory and shared copy-on-write with the
+        # workers; DataLoader(pin_memory=True) pins the collated batch.
+        self.preload = preload
+        self._cache = {}
+        if self.preload:
+            for index in range(self.len):
+                self._cache[index] = self._preload_demo(index)
+
     def __len__(self):
         return self.len
 
+    def _parse_task_ind(self, file_name):
+        """
+        Return the (skill_ind, env_ind) one-hot tensors encoded in a demo file name
+        """
+        skill_ind = self._SKILL_NONE
+        if self.add_task_ind:
+            if "backward" in file_name:
+                skill_ind = self._SKILL_BWD
+            elif "forward" in file_name:
+                skill_ind = self._SKILL_FWD
+
+        env_id = file_name.replace(".pickle", "")[-1]
+        if env_id == "1":  # box
+            env_ind = self._ENV_TAB[0]
+        elif env_id == "3":  # toilet seat
+            env_ind = self._ENV_TAB[1]
+        elif env_id == "5":  # grill
+            env_ind = self._ENV_TAB[2]
+        else:
+            skill_ind = self._SKILL_NONE
+            env_ind = self._ENV_NONE
+        return skill_ind, env_ind
+
+    def _read_demo(self, index):
+        """
+        Return the demo at index as a {key: array} mapping. Demos converted with
+        convert_pickle_to_npy are memory-mapped, so only the sampled window is
+        read from disk; otherwise the pickle is loaded. Each memory-map holds an
+        open file descriptor, so the maps are opened per call (reading a .npy
+        header is cheap) and closed once the caller drops them, instead of being
+        cached per worker. .npy files older than the pickle are stale (the demo
+        was regenerated after conversion) and are ignored.
+        """
+        file_name = self.file_list[index]
+        npy_dir = os.path.splitext(file_name)[0]
+        npy_paths = {
+            key: os.path.join(npy_dir, f"{key}.npy") for key in self.required_data_keys
+        }
+        if index not in self._use_npy:
+            self._use_npy[index] = all(
+                os.path.isfile(path)
+                and os.path.getmtime(path) >= os.path.getmtime(file_name)
+                for path in npy_paths.values()
+            )
+        if self._use_npy[index]:
+            return {
+                key: np.load(path, mmap_mode="r") for key, path in npy_paths.items()
+            }
+
+        with open(file_name, "rb") as f:
+            return pickle.load(f)
+
+    def _preload_demo(self, index):
+        demo = self._read_demo(index)
+        cached = {}
+        for key in self.required_data_keys:
+            data = np.array(demo[key])  # copy, also out of a memory-map
+            if "position" in key and self.normalizer is not None:
+                data = self.normalizer.transform_batch(data)
+            cached[key] = data
+        return cached
+
     def __getitem__(self, index):
-        with open(self.file_list[index], "rb") as f:
-            demo = pickle.load(f)
-            valid_keys = []
-            for key in demo:
-                if len(demo[key]) > 0:
-                    valid_keys.append(key)
-
-            assert len(valid_keys) > 0
-            assert all([req_key in valid_keys for req_key in self.required_data_keys])
-
-            episode_len = len(demo[valid_keys[0]])
-            # start_ts = np.random.choice(episode_len)
-            # Sample start_ts from a distribution
-            start_ts = int(self.sampler() * episode_len)
-            end_ts = min(episode_len, start_ts + self.chunk_size)
-
-            image_dict = {}
-            data_batch = {}
-            for key in self.required_data_keys:
-                if "position" in key:
-                    chunk_data = demo[key][start_ts:end_ts]
-                    if self.normalizer is not None:
-                        for i, js in enumerate(chunk_data):
-                            if self.normalizer.validate_bounds(js):
-                                chunk_data[i] = self.normalizer.transform(js)
-                            chunk_data[i] = self.normalizer.clamp(js)
-
-                    data = torch.zeros((self.chunk_size, CONFIG_DIM))
-                    data[: end_ts - start_ts, :] = torch.as_tensor(np.array(chunk_data))
-                    data_batch["joint_action"] = data
-                elif "gripper" in key:
-                    chunk_data = demo[key][start_ts:end_ts]
-                    data = torch.zeros((self.chunk_size))
-                    data[: end_ts - start_ts] = torch.as_tensor(np.array(chunk_data))
-                    data_batch["gripper_action"] = data
-                elif "rgb" in key:
-                    image_dict[key] = demo[key][start_ts]
-                else:
-                    data = demo[key][start_ts]
-                    data = torch.as_tensor(data)
-                    data_batch[key] = data
-
-            all_cam_images = []
-            for cam_name in ReverseTrajDataset.camera_names:
-                all_cam_images.append(image_dict[cam_name])
-            all_cam_images = torch.from_numpy(np.stack(all_cam_images, axis=0))
-            image_data = torch.einsum(
-                "k h w c -> k c h w", all_cam_images
-            )  # channel last
-            # normalize image and change dtype to float
-            image_data = image_data / 255.0
-            data_batch["images"] = image_data
-            is_pad = np.ones((self.chunk_size))
-            is_pad[: end_ts - start_ts] = 0
-            data_batch["is_pad"] = torch.from_numpy(is_pad).bool()
-            if self.add_task_ind:
-                if "backward" in self.file_list[index]:
-                    skill_ind = torch.tensor([0.0, 1.0], dtype=torch.float32)
-                elif "forward" in self.file_list[index]:
-                    skill_ind = torch.tensor([1.0, 0.0], dtype=torch.float32)
-
-            if self.file_list[index].replace(".pickle", "")[-1] == "1":  # box
-                env_ind = torch.tensor([1.0, 0.0, 0.0], dtype=torch.float32)
-            elif self.file_list[index].replace(".pickle", "")[-1] == "3":  # toilet seat
-                env_ind = torch.tensor([0.0, 1.0, 0.0], dtype=torch.float32)
-            elif self.file_list[index].replace(".pickle", "")[-1] == "5":  # grill
-                env_ind = torch.tensor([0.0, 0.0, 1.0], dtype=torch.float32)
+        demo = self._cache[index] if self.preload else self._read_demo(index)
+        valid_keys = []
+        for key in demo:
+            if len(demo[key]) > 0:
+                valid_keys.append(key)
+
+        assert len(valid_keys) > 0
+        assert all([req_key in valid_keys for req_key in self.required_data_keys])
+
+        episode_len = len(demo[valid_keys[0]])
+        # start_ts = np.random.choice(episode_len)
+        # Sample start_ts from a distribution
+        start_ts = int(self.sampler() * episode_len)
+        end_ts = min(episode_len, start_ts + self.chunk_size)
+
+        image_dict = {}
+        data_batch = {}
+        for key in self.required_data_keys:
+            if "position" in key:
+                # Copy the window out of the (possibly read-only memory-mapped) demo
+                chunk_data = np.array(demo[key][start_ts:end_ts])
+                if self.normalizer is not None and not self.preload:
+                    chunk_data = self.normalizer.transform_batch(chunk_data)
+
+                data = torch.zeros((self.chunk_size, CONFIG_DIM))
+                data[: end_ts - start_ts, :] = torch.from_numpy(chunk_data)
+                data_batch["joint_action"] = data
+            elif "gripper" in key:
+                chunk_data = demo[key][start_ts:end_ts]
+                data = torch.zeros((self.chunk_size))
+                data[: end_ts - start_ts] = torch.as_tensor(np.array(chunk_data))
+                data_batch["gripper_action"] = data
+            elif "rgb" in key:
+                image_dict[key] = demo[key][start_ts]
             else:
-                skill_ind = torch.tensor([0, 0], dtype=torch.float32)
-                env_ind = torch.tensor([0, 0, 0], dtype=torch.float32)
-
-            data_batch["skill_ind"] = skill_ind.squeeze()
-            data_batch["env_ind"] = env_ind.squeeze()
-
-        assert data_batch["images"].shape == torch.Size([4, 3, 128, 128])
+                data = np.array(demo[key][start_ts])
+                data = torch.as_tensor(data)
+                data_batch[key] = data
+
+        # Keep images uint8 and channel last, the policy converts on device
+        all_cam_images = [
+            image_dict[cam_name] for cam_name in ReverseTrajDataset.camera_names
+        ]
+        data_batch["images"] = torch.from_numpy(np.stack(all_cam_images, axis=0))
+        is_pad = np.ones((self.chunk_size))
+        is_pad[: end_ts - start_ts] = 0
+        data_batch["is_pad"] = torch.from_numpy(is_pad).bool()
+        data_batch["skill_ind"] = self.skill_inds[index]
+        data_batch["env_ind"] = self.env_inds[index]
+
+        assert data_batch["images"].shape == torch.Size([4, 128, 128, 3])
+        assert data_batch["images"].dtype == torch.uint8
         assert data_batch["is_pad"].shape == torch.Size([self.chunk_size])
         assert data_batch["joint_action"].shape == torch.Size([self.chunk_size, 7])
         assert data_batch["gripper_action"].shape == torch.Size([self.chunk_size])
@@ -173,23 +293,55 @@ class ReverseTrajDataset(Dataset):
         return data_batch
 
 
+class PrefetchLoader(object):
+    """
+    Wraps a DataLoader and copies every batch to the device on a side CUDA
+    stream, so the copy of the next batch overlaps with compute on the current
+    one. Images stay uint8 and channel last, so only a quarter of the bytes go
+    over PCIe; the policies convert and normalize them on the device.
+    """
+
+    def __init__(self, loader, device="cuda"):
+        self.loader = loader
+        self.device = device
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        stream = torch.cuda.Stream()
+        batch = None
+        for next_batch in self.loader:
+            with torch.cuda.stream(stream):
+                next_batch = {
+                    key: value.to(self.device, non_blocking=True)
+                    for key, value in next_batch.items()
+                }
+            if batch is not None:
+                yield batch
+            torch.cuda.current_stream().wait_stream(stream)
+            for value in next_batch.values():
+                # Allocated on the side stream but consumed on the current one
+                value.record_stream(torch.cuda.current_stream())
+            batch = next_batch
+        if batch is not None:
+            yield batch
+
+
 def load_data(
     dataset_dir,
     task_name="box_open",
-    required_data_keys=[
-        "front_rgb",
-        "left_shoulder_rgb",
-        "right_shoulder_rgb",
-        "wrist_rgb",
-        "joint_positions",
-        "gripper_open",
-    ],
+    required_data_keys=REQUIRED_DATA_KEYS,
     chunk_size=100,
     norm_bound=None,
     batch_size=8,
     train_split=0.8,
     add_task_ind=False,
     few_shot=None,
+    num_workers=4,
+    prefetch_factor=4,
+    persistent_workers=True,
+    preload=False,
 ):
     """
     Method to return a Dataloader of manipulator demonstrations
@@ -211,6 +363,14 @@ def load_data(
         Size of the batch
     train_split: float; default=0.8
         Train-test split
+    num_workers: int; default=4
+        Number of DataLoader worker processes
+    prefetch_factor: int; default=4
+        Batches loaded in advance by each worker
+    persistent_workers: bool; default=True
+        Keep the workers alive across epochs instead of re-spawning them
+    preload: bool; default=False
+        Load every demo into memory once, for datasets that fit (few-shot)
 
     Notes
     -----
@@ -299,6 +459,7 @@ def load_data(
         add_task_ind=add_task_ind,
         task_name=task_name,
         # sampler=partial(np.random.beta, 1.5, 1.5),
+        preload=preload,
     )
     val_dataset = ReverseTrajDataset(
         file_list=test_file_list,
@@ -307,23 +468,37 @@ def load_data(
         norm_bound=norm_bound,
         add_task_ind=add_task_ind,
         task_name=task_name,
+        preload=preload,
     )
 
+    loader_kwargs = dict(pin_memory=True, num_workers=num_workers)
+    if num_workers > 0:  # Only valid with worker processes
+        loader_kwargs["prefetch_factor"] = prefetch_factor
+        loader_kwargs["persistent_workers"] = persistent_workers
     train_loader = DataLoader(
         train_dataset,
         batch_size=batch_size,
         shuffle=True,
-        pin_memory=True,
-        num_workers=1,
-        prefetch_factor=1,
+        # Keep the last partial batch if it is the only one (few-shot)
+        drop_last=len(train_dataset) > batch_size,
+        **loader_kwargs,
     )
     val_loader = DataLoader(
         val_dataset,
         batch_size=batch_size,
         shuffle=True,
-        pin_memory=True,
-        num_workers=1,
-        prefetch_factor=1,
+        **loader_kwargs,
     )
 
     return train_loader, val_loader
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser("Convert pickled demos for memory-mapping")
+    parser.add_argument("dataset_dir", type=str)
+    parser.add_argument("--keys", nargs="*", default=REQUIRED_DATA_KEYS)
+    args = parser.parse_args()
+    for file in glob.glob(os.path.join(args.dataset_dir, "*.pickle")):
+        print(f"Converted {file} to {convert_pickle_to_npy(file, args.keys)}")